@@ -1,18 +1,82 @@
-import os, csv, json, time, hashlib
+import os, io, re, csv, json, time, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+from soupsieve import compile as sv_compile
+from urllib.parse import urljoin, urlparse, urlsplit
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 import xml.etree.ElementTree as ET
 
+try:
+    import orjson
+except ImportError:  # orjson が無い環境では標準の json を使う
+    orjson = None
+
+try:
+    from lxml import etree
+    HTML_PARSER = "lxml"
+except ImportError:  # lxml が無い環境では標準ライブラリのパーサで動かす（遅いが結果は同じ）
+    etree = None
+    HTML_PARSER = "html.parser"
+
+try:
+    from blake3 import blake3 as new_hasher
+    HASH_ALGO = "blake3"
+except ImportError:  # blake3 が無い環境では従来どおり SHA-256
+    new_hasher = hashlib.sha256
+    HASH_ALGO = "sha256"
+
+# snapshots.json の "algo" → ハッシュ関数（アルゴリズムが変わった時に前回と同じ方式で計算し直すため）
+HASHERS = {"sha256": hashlib.sha256, HASH_ALGO: new_hasher}
+
+try:
+    from selectolax.lexbor import LexborHTMLParser, SelectolaxError
+except ImportError:  # selectolax が無い環境では BeautifulSoup だけで動かす
+    LexborHTMLParser = None
+
 TARGETS_CSV = "targets.csv"
 SNAPSHOT_JSON = "snapshots.json"
 
 MAX_ATOM_ITEMS = int(os.getenv("MAX_ATOM_ITEMS", "5"))
 MAX_HTML_LINKS = int(os.getenv("MAX_HTML_LINKS", "8"))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+MIN_INTERVAL = float(os.getenv("MIN_INTERVAL", "1"))  # 同一ホストへのリクエスト開始間隔（秒）
 JST = ZoneInfo("Asia/Tokyo")
 
+# selector無しの要約で使うのは <title> と <body> 配下だけ（<head> 内の script/style などは解析しない）
+# 省略された <body> を補ったり閉じタグを補完したりするのは lxml だけなので、html.parser では絞り込まない
+SUMMARY_STRAINER = SoupStrainer(["title", "body"]) if HTML_PARSER == "lxml" else None
+# BeautifulSoup の get_text() が読まない要素（selectolax の text() は中身まで含めてしまう）
+NON_TEXT_TAGS = ["script", "style", "template"]
+HIDING_REF_RE = re.compile(r"&(?!(?:amp|lt|gt|quot|apos|nbsp);)[#A-Za-z]")
+SIMPLE_SELECTOR_RE = re.compile(r"([A-Za-z][\w-]*)?((?:[.#][\w-]+)*)")
+# urljoin が書き換える可能性のある href
+# （"//" や "." セグメント、空のクエリ・フラグメント、";" パラメータ、空白・制御文字、IPv6表記）
+URLJOIN_REWRITES_RE = re.compile(r"//|/\.|\?#|[?#]$|[;\x00-\x20\[\]]")
+
+# 全リクエストで1つのSessionを使い回す（keep-aliveで接続・TLSハンドシェイクを再利用）
+SESSION = requests.Session()
+# Accept-Encoding は requests の既定値に任せる（brotli が入っていれば "gzip, deflate, br" になる）。
+# br を手で指定すると、brotli が無い環境で展開できない本文が返ってくるので固定しない
+SESSION.headers.update({"User-Agent": "PageMonitorBot/1.0"})
+# リトライは短い backoff だけ。Retry-After に従うと、1サイトの長い指定で後続のターゲットまで待たされる
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=False,
+    ),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
 
 def now_jst_str():
     return datetime.now(timezone.utc).astimezone(JST).strftime("%Y-%m-%d %H:%M:%S JST")
@@ -22,13 +86,27 @@ def normalize_text(s: str) -> str:
     return " ".join((s or "").split())
 
 
-def sha256(s: str) -> str:
-    return hashlib.sha256((s or "").encode("utf-8")).hexdigest()
+def fingerprint(s: str, hasher=None) -> str:
+    # 変化検知用の指紋（暗号用途ではない）。アルゴリズムは hasher 指定が無ければ HASH_ALGO
+    return (hasher or new_hasher)((s or "").encode("utf-8")).hexdigest()
+
 
+def fingerprint_joined(parts, hasher=None) -> str:
+    """fingerprint("\n".join(parts)) と同じ値を、連結した文字列を作らずに1要素ずつ流し込んで計算する"""
+    h = (hasher or new_hasher)()
+    for i, p in enumerate(parts):
+        if i:
+            h.update(b"\n")
+        h.update(p.encode("utf-8"))
+    return h.hexdigest()
 
+
+@lru_cache(maxsize=1024)
 def parse_keywords(keyword: str):
     """
     keyword: '地震|津波|特別警報' みたいに OR 条件。
+    1本の正規表現（大文字小文字無視）にまとめてコンパイルして返す → 1回の走査で全キーワードを判定できる。
+    同じ keyword 文字列のターゲット同士ではコンパイル結果を共有する（パターンは不変なので安全）。
     空ならNone（フィルタなし）
     """
     k = (keyword or "").strip()
@@ -37,68 +115,191 @@ def parse_keywords(keyword: str):
     parts = [p.strip() for p in k.split("|") if p.strip()]
     if not parts:
         return None
-    return [p.lower() for p in parts]
+    return re.compile("|".join(re.escape(p) for p in parts), re.IGNORECASE)
+
+
+def keyword_prefilterable(keyword: str) -> bool:
+    """
+    生の本文を検索するだけで「一致0件」と判定してよいキーワードか。
+    空白（抽出時に正規化される）や & < > " ' （実体参照で書かれうる）、
+    / . : ? # % （urljoin(base_url, href) の継ぎ目をまたいで初めて一致しうる）を含むものは解析して確かめる
+    """
+    parts = [p.strip() for p in (keyword or "").split("|") if p.strip()]
+    return bool(parts) and not any(c.isspace() or c in "&<>\"'/.:?#%" for p in parts for c in p)
 
 
 def match_any(text: str, kws):
-    if not kws:
+    if kws is None:
         return True
-    t = (text or "").lower()
-    return any(k in t for k in kws)
+    return kws.search(text or "") is not None
 
 
 def load_targets():
     targets = []
     with open(TARGETS_CSV, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        # ヘッダから列位置を1回だけ求め、各行は位置で直接取り出す（行ごとのdict生成を省く）
+        col = {h.strip(): i for i, h in enumerate(next(reader, []))}
+        if "id" not in col or "url" not in col:
+            return targets
+
+        def cell(row, key):
+            i = col.get(key)
+            return row[i].strip() if i is not None and i < len(row) else ""
+
         for row in reader:
-            if not row.get("id") or not row.get("url"):
+            tid = cell(row, "id")
+            url = cell(row, "url")
+            if not tid or not url:
                 continue
-            row["selector"] = (row.get("selector") or "").strip()
-            row["name"] = (row.get("name") or row["id"]).strip()
-            row["keyword"] = (row.get("keyword") or "").strip()
-            targets.append(row)
+            keyword = cell(row, "keyword")
+            targets.append({
+                "id": tid,
+                "name": cell(row, "name") or tid,
+                "url": url,
+                "selector": cell(row, "selector"),
+                "keyword": keyword,
+                # 毎回の解析で使う値はここで1回だけ作っておく
+                "_kws": parse_keywords(keyword),
+                "_xml_url": url.lower().endswith(".xml"),
+                "_prefilter": keyword_prefilterable(keyword),
+            })
     return targets
 
 
 def load_snapshots():
     if not os.path.exists(SNAPSHOT_JSON):
         return {}
+    if orjson is not None:
+        with open(SNAPSHOT_JSON, "rb") as f:
+            return orjson.loads(f.read())
     with open(SNAPSHOT_JSON, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
 def save_snapshots(data):
-    with open(SNAPSHOT_JSON, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # 一時ファイルに書いてから置き換える（途中で落ちても snapshots.json が壊れない）
+    # orjson の OPT_INDENT_2 は json.dump(ensure_ascii=False, indent=2) と同じ形で出力される
+    tmp = SNAPSHOT_JSON + ".tmp"
+    if orjson is not None:
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, SNAPSHOT_JSON)
 
 
-def fetch(url: str):
-    r = requests.get(url, headers={"User-Agent": "PageMonitorBot/1.0"}, timeout=30)
-    r.raise_for_status()
-    r.encoding = "utf-8"
-    ctype = (r.headers.get("Content-Type") or "").lower()
-    return r.text, ctype
+def fetch(url: str, etag: str = "", last_modified: str = ""):
+    """
+    etag / last_modified があれば条件付きGET。
+    304 Not Modified のときは body=None を返す（本文のダウンロード・解析を丸ごと省略できる）
+    本文は受信しながら指紋を計算し、(body, ctype, etag, last_modified, body_hash) を返す
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    with SESSION.get(url, headers=headers, timeout=30, stream=True) as r:
+        if r.status_code == 304:
+            return None, "", etag, last_modified, ""
+        r.raise_for_status()
+
+        h = new_hasher()
+        buf = bytearray()
+        for chunk in r.iter_content(65536):
+            h.update(chunk)
+            buf += chunk
+
+        body = buf.decode("utf-8", errors="replace")
+        ctype = (r.headers.get("Content-Type") or "").lower()
+        etag = r.headers.get("ETag") or ""
+        last_modified = r.headers.get("Last-Modified") or ""
+        return body, ctype, etag, last_modified, h.hexdigest()
+
+
+def same_target_config(prev, selector: str, keyword: str) -> bool:
+    # selector/keyword を変えた直後や、指紋のアルゴリズムが変わった直後は、ページが同じでも再評価が必要
+    return (
+        bool(prev)
+        and prev.get("selector") == selector
+        and prev.get("keyword") == keyword
+        and prev.get("algo", "sha256") == HASH_ALGO
+    )
 
 
-def parse_atom(xml_text: str, base_url: str, kws):
-    root = ET.fromstring(xml_text)
+def cache_validators(prev, selector: str, keyword: str):
+    if not same_target_config(prev, selector, keyword):
+        return "", ""
+    return prev.get("etag") or "", prev.get("last_modified") or ""
 
-    def local(tag):
-        return tag.split("}", 1)[-1] if "}" in tag else tag
 
-    entries = []
-    for e in root.iter():
-        if local(e.tag) != "entry":
-            continue
+_last_hit = {}  # host -> 直近のリクエスト開始時刻（time.monotonic）
+
+
+def wait_for_host(host: str, host_lock):
+    # 同じホストへのリクエストは開始間隔を MIN_INTERVAL 秒以上空ける。別ホストは待たない
+    with host_lock:
+        last = _last_hit.get(host)
+        if last is not None:
+            delay = MIN_INTERVAL - (time.monotonic() - last)
+            if delay > 0:
+                time.sleep(delay)
+        _last_hit[host] = time.monotonic()
+
+
+def polite_fetch(host_lock, url: str, etag: str = "", last_modified: str = ""):
+    # ワーカースレッドで実行。待つのは同じホストに連続で当たる時だけ（取得後の一律sleepはしない）
+    wait_for_host(urlparse(url).netloc, host_lock)
+    return fetch(url, etag, last_modified)
+
 
+def local_name(tag):
+    return tag.split("}", 1)[-1] if "}" in tag else tag
+
+
+def iter_atom_entries(xml_text: str):
+    """
+    <entry> 要素を文書順に1つずつ返す（DOM全体は作らない）。
+    呼び出し側が読み終えた entry は次へ進む時に捨て、メモリを一定に保つ
+    """
+    if etree is not None:
+        # lxml(C実装)で entry だけを逐次パース。
+        # 本文は fetch() で UTF-8 としてデコード済みなので encoding を固定。
+        # DTD内で定義された実体だけ展開し（標準の ElementTree と同じ結果）、外部実体は読みに行かない
+        source = io.BytesIO(xml_text.encode("utf-8"))
+        for _, e in etree.iterparse(source, tag="{*}entry", encoding="utf-8", resolve_entities="internal"):
+            yield e
+            e.clear()
+            while e.getprevious() is not None:
+                del e.getparent()[0]
+        return
+
+    root = None
+    for event, e in ET.iterparse(io.StringIO(xml_text), events=("start", "end")):
+        if root is None:
+            root = e
+        if event == "end" and local_name(e.tag) == "entry":
+            yield e
+            e.clear()
+            root.clear()
+
+
+def parse_atom(xml_text: str, base_url: str, kws, hasher=None):
+    # MAX_ATOM_ITEMS 件そろった時点で打ち切る
+    entries = []
+    for e in iter_atom_entries(xml_text):
         title = ""
         link = ""
         updated = ""
         eid = ""
 
-        for ch in list(e):
-            t = local(ch.tag)
+        for ch in e:
+            if not isinstance(ch.tag, str):  # コメント・処理命令
+                continue
+            t = local_name(ch.tag)
             if t == "title":
                 title = normalize_text(ch.text or "")
             elif t == "updated":
@@ -115,18 +316,36 @@ def parse_atom(xml_text: str, base_url: str, kws):
 
         if title or link:
             entries.append({"title": title, "link": link, "updated": updated, "id": eid})
+            if len(entries) >= MAX_ATOM_ITEMS:
+                break
+
+    return atom_observation(entries, hasher)
 
-    entries = entries[:MAX_ATOM_ITEMS]
 
+def atom_observation(entries, hasher=None):
+    """
+    (hash, preview, entry_hashes, render_lines) を返す（parse_html / value_observation も同じ形）。
+    entry_hashes は1件ごとの指紋で、前回の一覧と比べれば新しく出てきた項目が分かる。
+    通知本文の抜粋は変化があった時しか使わないので、render_lines(前回の entry_hashes) を呼んだ時に組み立てる
+    """
     # フィルタ後の内容だけで比較（＝関係ない更新では通知しない）
-    hash_src = "\n".join(
-        [f"{x.get('id')}|{x.get('updated')}|{x.get('title')}|{x.get('link')}" for x in entries]
-    )
+    keys = [f"{x.get('id')}|{x.get('updated')}|{x.get('title')}|{x.get('link')}" for x in entries]
+    content_hash = fingerprint_joined(keys, hasher)
+    entry_hashes = [fingerprint(k, hasher) for k in keys]
     preview = " / ".join([x.get("title", "") for x in entries])[:300]
+    return content_hash, preview, entry_hashes, partial(atom_lines, entries, entry_hashes)
+
 
+def new_mark(h, known):
+    # 前回の一覧に無かった項目に印を付ける（前回の一覧が無ければ付けない）
+    return "🆕 " if known and h not in known else ""
+
+
+def atom_lines(entries, entry_hashes, known=()):
+    known = set(known)
     lines = []
-    for x in entries:
-        t = x.get("title") or "(no title)"
+    for x, h in zip(entries, entry_hashes):
+        t = new_mark(h, known) + (x.get("title") or "(no title)")
         u = x.get("link") or ""
         up = x.get("updated") or ""
         if up:
@@ -136,38 +355,127 @@ def parse_atom(xml_text: str, base_url: str, kws):
         if u:
             lines.append(f"  {u}")
         lines.append("")  # 空行で見やすく
+    return lines
+
+
+def page_title_and_anchors(html: str):
+    """
+    selector無し監視用：(title, anchors) を返す。anchors は (リンク文字列, href) のイテレータ。
+    selectolax があればC実装のパーサで解析（BeautifulSoupより桁違いに速い）
+    """
+    if LexborHTMLParser is None:
+        soup = BeautifulSoup(html, HTML_PARSER, parse_only=SUMMARY_STRAINER)
+        title = soup.title.get_text(strip=True) if soup.title else ""
+        main = soup.find("main") or soup.body or soup
+        # CSSセレクタを使わずツリーを順に辿る（遅延評価なので MAX_HTML_LINKS 件集まれば走査も止まる）
+        anchors = (
+            (a.get_text(" ", strip=True), a.get("href"))
+            for a in main.descendants
+            if a.name == "a" and a.has_attr("href")
+        )
+        return title, anchors
+
+    tree = LexborHTMLParser(html)
+    node = tree.css_first("title")
+    title = node.text(strip=True) if node else ""
+    main = tree.css_first("main") or tree.body or tree.root
+    main.strip_tags(NON_TEXT_TAGS)
+    anchors = ((a.text(separator=" ", strip=True), a.attributes.get("href")) for a in main.css("a[href]"))
+    return title, anchors
 
-    return hash_src, preview, lines
 
+@lru_cache(maxsize=256)
+def compiled_selector(selector: str):
+    # targets.csv のセレクタは毎回同じなので、コンパイル結果を文字列ごとに使い回す
+    return sv_compile(selector)
 
-def parse_html(html: str, base_url: str, selector: str, kws):
-    soup = BeautifulSoup(html, "html.parser")
 
+@lru_cache(maxsize=256)
+def selector_strainer(selector: str):
+    """
+    tag / #id / .class を並べただけの単純なセレクタなら、一致しうる要素だけを解析する SoupStrainer を返す。
+    結合子や疑似クラスを含むセレクタは祖先・兄弟が必要なので None（文書全体を解析）。
+    html.parser は閉じタグを補完しないので、絞り込むと要素の範囲が変わってしまう → 常に None
+    """
+    m = SIMPLE_SELECTOR_RE.fullmatch(selector)
+    if not m or not selector or HTML_PARSER != "lxml":
+        return None
+    tag, rest = m.groups()
+    if tag:
+        return SoupStrainer(tag.lower())
+    kind, name = rest[0], re.split(r"[.#]", rest[1:], 1)[0]
+    if kind == "#":
+        return SoupStrainer(id=name)
+    # 解析時点の class 属性は分割前の文字列なので、単語として含むかを正規表現で判定する
+    return SoupStrainer(class_=re.compile(r"(?:^|\s)" + re.escape(name) + r"(?:\s|$)"))
+
+
+def selected_text(html: str, selector: str) -> str:
+    """
+    selector に最初に一致した要素のテキスト（無ければ空文字）。
+    selectolax が解釈できないセレクタ（:-soup-contains() など）は BeautifulSoup で処理する
+    """
+    if LexborHTMLParser is not None:
+        try:
+            node = LexborHTMLParser(html).css_first(selector)
+            if node is None:
+                return ""
+            # 一致した要素の中の script / style だけ落とす（要素自体が script なら BeautifulSoup 同様その中身を返す）
+            node.strip_tags(NON_TEXT_TAGS)
+            return node.text(separator=" ", strip=True)
+        except SelectolaxError:
+            pass
+
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=selector_strainer(selector))
+    el = compiled_selector(selector).select_one(soup)
+    return el.get_text(" ", strip=True) if el else ""
+
+
+def href_resolver(base_url: str):
+    """
+    href を base_url 基準の絶対URLにする関数を返す（結果は urljoin(base_url, href) と同じ）。
+    よくある「絶対URL」「ルート相対パス」は、base_url を毎回解析し直さずに文字列の連結だけで済ませる
+    """
+    base = urlsplit(base_url)
+    if base.scheme not in ("http", "https") or not base.netloc:
+        return partial(urljoin, base_url)
+    origin = f"{base.scheme}://{base.netloc}"
+
+    def resolve(href: str) -> str:
+        if href.startswith(("http://", "https://")):
+            rest = href.split("://", 1)[1]
+            if rest[:1] not in ("", "/", "?", "#") and not URLJOIN_REWRITES_RE.search(rest):
+                return href
+        elif href[:1] == "/" and not URLJOIN_REWRITES_RE.search(href):
+            return origin + href
+        return urljoin(base_url, href)
+
+    return resolve
+
+
+def parse_html(html: str, base_url: str, selector: str, kws, hasher=None):
     # selector指定：その部分だけ監視
     if selector:
-        el = soup.select_one(selector)
-        text = normalize_text(el.get_text(" ", strip=True)) if el else ""
+        text = normalize_text(selected_text(html, selector))
         if not match_any(text, kws):
             text = ""  # キーワード不一致なら空扱い（通知しない）
-        hash_src = text
-        preview = text[:300]
-        lines = [f"- value: {preview}"] if preview else ["- value: (no keyword match / empty)"]
-        return hash_src, preview, lines
+        return value_observation(text, hasher)
 
     # selector無し：タイトル＋主要リンクを抽出（要約）
-    title = normalize_text(soup.title.get_text(strip=True)) if soup.title else ""
-    main = soup.find("main") or soup.body or soup
+    title, anchors = page_title_and_anchors(html)
+    title = normalize_text(title)
+    resolve = href_resolver(base_url)
 
     links = []
-    for a in main.select("a[href]"):
-        txt = normalize_text(a.get_text(" ", strip=True))
-        href = (a.get("href") or "").strip()
+    for txt, href in anchors:
+        txt = normalize_text(txt)
+        href = (href or "").strip()
         if not txt or len(txt) < 2:
             continue
         if href.startswith("#") or href.lower().startswith("javascript:"):
             continue
 
-        absu = urljoin(base_url, href)
+        absu = resolve(href)
 
         if not match_any(txt + " " + absu, kws):
             continue
@@ -176,28 +484,58 @@ def parse_html(html: str, base_url: str, selector: str, kws):
         if len(links) >= MAX_HTML_LINKS:
             break
 
-    hash_src = title + "\n" + "\n".join([f"{t}|{u}" for t, u in links])
+    # title + "\n" + "\n".join(リンク) と同じハッシュ（リンク0件なら末尾の改行だけ残る）
+    keys = [f"{t}|{u}" for t, u in links]
+    content_hash = fingerprint_joined([title] + (keys or [""]), hasher)
+    entry_hashes = [fingerprint(k, hasher) for k in keys]
     preview = (title or (links[0][0] if links else ""))[:300]
+    return content_hash, preview, entry_hashes, partial(summary_lines, title, links, entry_hashes)
+
 
+def summary_lines(title, links, entry_hashes, known=()):
+    known = set(known)
     lines = []
     lines.append(f"- title: {title}" if title else "- title: (none)")
     if links:
         lines.append("- matched links:")
-        for t, u in links:
-            lines.append(f"  • {t}")
+        for (t, u), h in zip(links, entry_hashes):
+            lines.append(f"  • {new_mark(h, known)}{t}")
             lines.append(f"    {u}")
     else:
         lines.append("- matched links: (none)")
+    return lines
+
+
+def value_observation(text: str, hasher=None):
+    preview = text[:300]
+    return fingerprint(text, hasher), preview, [], partial(value_lines, preview)
+
+
+def value_lines(preview, known=()):
+    return [f"- value: {preview}"] if preview else ["- value: (no keyword match / empty)"]
+
 
-    return hash_src, preview, lines
+def body_may_match(body: str, base_url: str, kws) -> bool:
+    # 相対リンクは base_url と結合されるので、base_url 側の一致も考慮する
+    if kws.search(body) or kws.search(base_url):
+        return True
+    # &#x5730; や &eacute; などの参照にキーワードの文字が隠れている可能性がある時は解析して確かめる
+    return HIDING_REF_RE.search(body) is not None
+
+
+def extract_observation(
+    url: str, body: str, content_type: str, selector: str, kws, xml_url: bool, prefilter: bool, hasher=None
+):
+    is_xml = xml_url or ("xml" in content_type)
 
+    # 生の本文にキーワードが1つも無ければ、解析しても一致0件なので解析自体を省く
+    # （selector無しのHTML要約はキーワードに関係なくタイトルを含むので対象外）
+    if prefilter and (is_xml or selector) and not body_may_match(body, url, kws):
+        return atom_observation([], hasher) if is_xml else value_observation("", hasher)
 
-def extract_observation(url: str, body: str, content_type: str, selector: str, keyword: str):
-    kws = parse_keywords(keyword)
-    is_xml = url.lower().endswith(".xml") or ("xml" in content_type)
     if is_xml:
-        return parse_atom(body, url, kws)
-    return parse_html(body, url, selector, kws)
+        return parse_atom(body, url, kws, hasher)
+    return parse_html(body, url, selector, kws, hasher)
 
 
 def discord_post(webhook_url: str, text: str):
@@ -205,20 +543,27 @@ def discord_post(webhook_url: str, text: str):
         print("DISCORD_WEBHOOK_URL empty; skip notify")
         return
 
-    chunks = []
-    while text:
-        chunks.append(text[:1800])
-        text = text[1800:]
+    # 先頭から1800文字ずつ切り出す（残りの文字列を毎回作り直さない）
+    chunks = [text[i:i + 1800] for i in range(0, len(text), 1800)]
 
+    # 順番が入れ替わらないよう1通ずつ送る。待つのは Discord にレート制限を示された時だけ
     for c in chunks:
-        res = requests.post(
-            webhook_url,
-            data=json.dumps({"content": c}),
-            headers={"Content-Type": "application/json"},
-            timeout=30,
-        )
+        payload = orjson.dumps({"content": c}) if orjson is not None else json.dumps({"content": c})
+        for _ in range(3):
+            res = SESSION.post(
+                webhook_url,
+                data=payload,
+                headers={"Content-Type": "application/json"},
+                timeout=30,
+            )
+            if res.status_code != 429:
+                break
+            time.sleep(float(res.headers.get("Retry-After") or 1))
         print("discord status:", res.status_code)
 
+        if res.headers.get("X-RateLimit-Remaining") == "0":
+            time.sleep(float(res.headers.get("X-RateLimit-Reset-After") or 1))
+
 
 def main():
     webhook_url = os.getenv("DISCORD_WEBHOOK_URL", "")
@@ -231,75 +576,131 @@ def main():
 
     changes_msgs = []
     ts = now_jst_str()
-
-    for t in targets:
-        tid = t["id"]
-        name = t["name"]
-        url = t["url"]
-        selector = t["selector"]
-        keyword = t.get("keyword", "")
-
-        try:
-            body, ctype = fetch(url)
-            hash_src, new_preview, new_lines = extract_observation(url, body, ctype, selector, keyword)
-            new_hash = sha256(hash_src)
-        except Exception as e:
-            changes_msgs.append(f"⚠️ 取得失敗 [{name}]\n🕘 {ts}\n{url}\n{type(e).__name__}: {e}")
-            continue
-
-        prev = snapshots.get(tid)
-
-        # ✅ keywordがあるのに一致0件なら「通知しない＆前回状態を維持」
-        # （一致が出た時だけ通知するため）
-        if (keyword or "").strip() and not (new_preview or "").strip():
-            if prev and (prev.get("preview") or "").strip():
-                print(f"No keyword match now: {tid} -> keep previous snapshot (skip notify)")
-                time.sleep(1)
+    dirty = False  # snapshots を書き換えたか（変化が無い回はファイルを書き直さない）
+
+    # 取得（ネットワーク待ち）だけ並列化し、解析・スナップショット更新は targets の順にメインスレッドで行う
+    host_locks = {urlparse(t["url"]).netloc: threading.Lock() for t in targets}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = [
+            pool.submit(
+                polite_fetch,
+                host_locks[urlparse(t["url"]).netloc],
+                t["url"],
+                *cache_validators(snapshots.get(t["id"]), t["selector"], t.get("keyword", "")),
+            )
+            for t in targets
+        ]
+
+        for t, fut in zip(targets, futures):
+            tid = t["id"]
+            name = t["name"]
+            url = t["url"]
+            selector = t["selector"]
+            keyword = t.get("keyword", "")
+            prev = snapshots.get(tid)
+
+            try:
+                body, ctype, etag, last_modified, body_hash = fut.result()
+                if body is None:
+                    # 304：前回から変化なし（解析もハッシュ計算も不要）
+                    print(f"Not modified: {tid}")
+                    continue
+                if same_target_config(prev, selector, keyword) and prev.get("body_hash") == body_hash:
+                    # 本文が前回とまったく同じなら解析を省略し、前回の結果をそのまま使う
+                    print(f"Body unchanged: {tid}")
+                    new_hash, new_preview = prev.get("hash"), prev.get("preview") or ""
+                    entry_hashes, render_lines = prev.get("entry_hashes", []), lambda known: []
+                else:
+                    new_hash, new_preview, entry_hashes, render_lines = extract_observation(
+                        url, body, ctype, selector, t["_kws"], t["_xml_url"], t["_prefilter"]
+                    )
+            except Exception as e:
+                changes_msgs.append(f"⚠️ 取得失敗 [{name}]\n🕘 {ts}\n{url}\n{type(e).__name__}: {e}")
                 continue
 
-        # 初回は登録だけ（通知しない）
-        if not prev:
-            snapshots[tid] = {
-                "name": name,
-                "url": url,
-                "selector": selector,
-                "keyword": keyword,
-                "hash": new_hash,
-                "preview": new_preview,
-                "updated_at_jst": ts,
-            }
-            print(f"First seen: {tid}")
-            time.sleep(1)
-            continue
-
-        if prev.get("hash") != new_hash:
-            old_preview = (prev.get("preview") or "")[:300]
-            header = f"🚨 更新検知 [{name}]\n🕘 {ts}\n{url}"
-            if selector:
-                header += f"\nselector: {selector}"
-            if keyword:
-                header += f"\nkeyword: {keyword}"
-
-            msg = header + f"\nbefore: {old_preview}\nafter : {new_preview[:300]}"
-            if new_lines:
-                msg += "\n\n最新の内容（抜粋）\n" + "\n".join(new_lines[:40])
-
-            changes_msgs.append(msg)
-
-            snapshots[tid] = {
-                "name": name,
-                "url": url,
-                "selector": selector,
-                "keyword": keyword,
-                "hash": new_hash,
-                "preview": new_preview,
-                "updated_at_jst": ts,
-            }
-
-        time.sleep(1)
+            # ✅ keywordがあるのに一致0件なら「通知しない＆前回状態を維持」
+            # （一致が出た時だけ通知するため）
+            if (keyword or "").strip() and not (new_preview or "").strip():
+                if prev and (prev.get("preview") or "").strip():
+                    print(f"No keyword match now: {tid} -> keep previous snapshot (skip notify)")
+                    continue
+
+            # 指紋のアルゴリズムが変わったエントリは、前回と同じアルゴリズムで計算し直して前回値と比べる
+            rehash = bool(prev) and prev.get("algo", "sha256") != HASH_ALGO
+            unchanged_before_rehash = False
+            if rehash:
+                old_hasher = HASHERS.get(prev.get("algo", "sha256"))
+                unchanged_before_rehash = old_hasher is not None and extract_observation(
+                    url, body, ctype, selector, t["_kws"], t["_xml_url"], t["_prefilter"], old_hasher
+                )[0] == prev.get("hash")
+
+            # 初回は登録だけ（通知しない）
+            # アルゴリズムが変わっただけで内容が前回と同じなら、通知せずに新しいアルゴリズムで登録し直す
+            if not prev or unchanged_before_rehash:
+                snapshots[tid] = {
+                    "name": name,
+                    "url": url,
+                    "selector": selector,
+                    "keyword": keyword,
+                    "hash": new_hash,
+                    "preview": new_preview,
+                    "updated_at_jst": ts,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "body_hash": body_hash,
+                    "algo": HASH_ALGO,
+                    "entry_hashes": entry_hashes,
+                }
+                dirty = True
+                print(f"First seen: {tid}" if not prev else f"Rehashed with {HASH_ALGO}: {tid}")
+                continue
 
-    save_snapshots(snapshots)
-    print(f"updated {SNAPSHOT_JSON}")
+            if rehash or prev.get("hash") != new_hash:
+                old_preview = (prev.get("preview") or "")[:300]
+                header = f"🚨 更新検知 [{name}]\n🕘 {ts}\n{url}"
+                if selector:
+                    header += f"\nselector: {selector}"
+                if keyword:
+                    header += f"\nkeyword: {keyword}"
+
+                msg = header + f"\nbefore: {old_preview}\nafter : {new_preview[:300]}"
+                new_lines = render_lines([] if rehash else prev.get("entry_hashes", []))
+                if new_lines:
+                    msg += "\n\n最新の内容（抜粋）\n" + "\n".join(new_lines[:40])
+
+                changes_msgs.append(msg)
+
+                snapshots[tid] = {
+                    "name": name,
+                    "url": url,
+                    "selector": selector,
+                    "keyword": keyword,
+                    "hash": new_hash,
+                    "preview": new_preview,
+                    "updated_at_jst": ts,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "body_hash": body_hash,
+                    "algo": HASH_ALGO,
+                    "entry_hashes": entry_hashes,
+                }
+                dirty = True
+            elif (prev.get("etag") or "", prev.get("last_modified") or "", prev.get("entry_hashes", [])) != (
+                etag, last_modified, entry_hashes
+            ):
+                # 内容は同じでも検証子が変わることがあるので、次回の条件付きGET用に保存しておく
+                # entry_hashes は古いスナップショットには無いので、初めて計算できた時に書き足す
+                prev["etag"] = etag
+                prev["last_modified"] = last_modified
+                prev["body_hash"] = body_hash
+                prev["entry_hashes"] = entry_hashes
+                dirty = True
+
+    if dirty:
+        save_snapshots(snapshots)
+        print(f"updated {SNAPSHOT_JSON}")
+    else:
+        print(f"No snapshot changes. Skip writing {SNAPSHOT_JSON}")
 
     if changes_msgs:
         discord_post(webhook_url, "\n\n".join(changes_msgs))